@@ -6,19 +6,59 @@ A service that listens for HTTP commands to restart Pangolin containers
 with randomized port assignments.
 """
 
+import atexit
+import copy
 import json
 import logging
+import logging.handlers
 import os
 import random
+import re
+import shlex
+import signal
 import subprocess
 import sys
 import yaml
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from threading import Lock
 
+# Prefer the libyaml-backed loader/dumper when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as _Loader, CSafeDumper as _Dumper
+except ImportError:
+    from yaml import SafeLoader as _Loader, SafeDumper as _Dumper
+
+
+def _stdlib_json_dumps(obj, indent=None):
+    """Serialize obj to JSON bytes with the stdlib encoder, compact unless indented"""
+    separators = None if indent else (',', ':')
+    return json.dumps(obj, indent=indent, separators=separators).encode('utf-8')
+
+
+# Prefer orjson for reading and writing the service config when available
+try:
+    import orjson
+
+    def _json_loads(data):
+        return orjson.loads(data)
+
+    def _json_dumps(obj, indent=None):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+        except TypeError:
+            # orjson rejects values the stdlib accepts, such as integers over 64 bits
+            return _stdlib_json_dumps(obj, indent=indent)
+except ImportError:
+    def _json_loads(data):
+        return json.loads(data)
+
+    _json_dumps = _stdlib_json_dumps
+
+
 # Global configuration
 CONFIG = {}
 logger = None
+log_buffer = None
 
 # Default configuration
 DEFAULT_CONFIG = {
@@ -48,88 +88,154 @@ app = Flask(__name__)
 restart_lock = Lock()
 
 
+class RestartInProgress(Exception):
+    """Raised when a restart is requested while another one is running"""
+
+
+# Parsed YAML files keyed by path: (st_mtime_ns, st_size, data)
+_yaml_cache = {}
+
+# Serialized GET response bodies, cleared whenever CONFIG changes. The lock
+# covers building and storing a body as well as replacing CONFIG and clearing,
+# so a body built from an older CONFIG is never stored after the clear
+_response_cache = {}
+_response_cache_lock = Lock()
+
+# Patterns for editing the gerbil port settings directly in the raw YAML text
+_CHILD_INDENT_RE = re.compile(r'^([ ]*)[^\s#]', re.M)
+_UDP_PORT_RE = re.compile(r'^(?P<lead>[ ]*-[ ]*)(?P<q>["\']?)\d+:\d+/udp(?P=q)', re.M)
+_TCP_PORT_RE = re.compile(r'^(?P<lead>[ ]*-[ ]*)(?P<q>["\']?)443:443(?P=q)(?=[ \r]|$)', re.M)
+
+
 def load_config(config_file="service_config.json"):
     """Load configuration from config file"""
     global CONFIG, logger
     
     if os.path.exists(config_file):
         try:
-            with open(config_file, 'r') as f:
-                CONFIG = json.load(f)
+            with open(config_file, 'rb') as f:
+                CONFIG = _json_loads(f.read())
             print(f"Loaded configuration from {config_file}")
         except Exception as e:
             print(f"Failed to load config file {config_file}: {e}")
             print("Using default configuration")
             CONFIG = DEFAULT_CONFIG.copy()
     else:
-        # Create default config file
+        # Create default config file, written compactly since it is machine generated
         CONFIG = DEFAULT_CONFIG.copy()
         try:
-            with open(config_file, 'w') as f:
-                json.dump(CONFIG, f, indent=2)
+            with open(config_file, 'wb') as f:
+                f.write(_json_dumps(CONFIG))
             print(f"Created default configuration file: {config_file}")
         except Exception as e:
             print(f"Failed to create config file {config_file}: {e}")
     
+    with _response_cache_lock:
+        _response_cache.clear()
+    
     # Setup logging after config is loaded
     setup_logging()
 
 
 def setup_logging():
-    """Setup logging based on configuration"""
-    global logger
+    """Setup logging based on configuration
+    
+    File logging goes through a MemoryHandler that writes records to disk in
+    batches of 100, or immediately for errors.
+    """
+    global logger, log_buffer
+    
+    # basicConfig(force=True) closes the old buffer but not the file it wraps
+    previous_file_handler = log_buffer.target if log_buffer else None
     
     log_level = getattr(logging, CONFIG["service"]["log_level"].upper(), logging.INFO)
+    log_format = '%(asctime)s - %(levelname)s - %(message)s'
     handlers = [logging.StreamHandler(sys.stdout)]
     
     if CONFIG["service"]["log_to_file"]:
-        handlers.append(logging.FileHandler(CONFIG["service"]["log_file"]))
+        # The buffer hands records to its target unformatted
+        file_handler = logging.FileHandler(CONFIG["service"]["log_file"])
+        file_handler.setFormatter(logging.Formatter(log_format))
+        log_buffer = logging.handlers.MemoryHandler(
+            capacity=100,
+            flushLevel=logging.ERROR,
+            target=file_handler
+        )
+        handlers.append(log_buffer)
+    else:
+        log_buffer = None
     
     logging.basicConfig(
         level=log_level,
-        format='%(asctime)s - %(levelname)s - %(message)s',
+        format=log_format,
         handlers=handlers,
         force=True  # Override any existing configuration
     )
     logger = logging.getLogger(__name__)
+    
+    if previous_file_handler:
+        previous_file_handler.close()
+
+
+def flush_log_buffer():
+    """Write any buffered log records to the log file"""
+    if log_buffer:
+        log_buffer.flush()
+
+
+atexit.register(flush_log_buffer)
+
+
+def handle_sigterm(signum, frame):
+    """Flush and close log handlers before exiting on SIGTERM, since atexit hooks do not run for it"""
+    logging.shutdown()
+    sys.exit(0)
 
 
 def run_command(command, cwd=None):
-    """Execute a shell command and return the result"""
+    """Execute a command given as an argument list and return the result
+    
+    Output is captured as bytes and only decoded when it is logged.
+    """
+    command_line = shlex.join(command)
     try:
-        logger.info(f"Executing: {command}")
+        logger.info("Executing: %s", command_line)
         result = subprocess.run(
             command,
-            shell=True,
+            shell=False,
             cwd=cwd,
             capture_output=True,
-            text=True,
             timeout=CONFIG["docker"]["timeout"]
         )
         
         if result.returncode == 0:
-            logger.info(f"Command succeeded: {command}")
-            if result.stdout.strip():
-                logger.debug(f"Output: {result.stdout.strip()}")
+            logger.info("Command succeeded: %s", command_line)
+            if logger.isEnabledFor(logging.DEBUG) and result.stdout.strip():
+                logger.debug("Output: %s", result.stdout.decode('utf-8', 'replace').strip())
         else:
-            logger.error(f"Command failed: {command}")
-            logger.error(f"Error: {result.stderr.strip()}")
+            logger.error("Command failed: %s", command_line)
+            logger.error("Error: %s", result.stderr.decode('utf-8', 'replace').strip())
             
         return result.returncode == 0, result.stdout, result.stderr
     except subprocess.TimeoutExpired:
-        logger.error(f"Command timed out: {command}")
-        return False, "", "Command timed out"
+        logger.error("Command timed out: %s", command_line)
+        return False, b"", b"Command timed out"
     except Exception as e:
-        logger.error(f"Failed to execute command: {command}, Error: {e}")
-        return False, "", str(e)
+        logger.error("Failed to execute command: %s, Error: %s", command_line, e)
+        return False, b"", str(e).encode('utf-8')
+
+
+def docker_compose_command(*args):
+    """Build the docker compose argument list, prefixed with sudo if configured"""
+    sudo_prefix = ["sudo"] if CONFIG["docker"]["use_sudo"] else []
+    return sudo_prefix + ["docker", "compose", *args]
 
 
 def stop_containers():
     """Stop the Pangolin docker containers"""
     logger.info("Stopping Pangolin containers...")
-    sudo_prefix = "sudo " if CONFIG["docker"]["use_sudo"] else ""
     success, stdout, stderr = run_command(
-        f"{sudo_prefix}docker compose down",
+        docker_compose_command("down"),
         cwd=CONFIG["pangolin"]["directory"]
     )
     return success
@@ -138,31 +244,163 @@ def stop_containers():
 def start_containers():
     """Start the Pangolin docker containers"""
     logger.info("Starting Pangolin containers...")
-    sudo_prefix = "sudo " if CONFIG["docker"]["use_sudo"] else ""
     success, stdout, stderr = run_command(
-        f"{sudo_prefix}docker compose up -d",
+        docker_compose_command("up", "-d"),
         cwd=CONFIG["pangolin"]["directory"]
     )
     return success
 
 
-def generate_random_port():
-    """Generate a random port within the configured range"""
-    port = random.randint(CONFIG["port_range"]["min"], CONFIG["port_range"]["max"])
-    logger.info(f"Generated random port: {port}")
+def generate_random_port(current_port=None):
+    """Generate a random port within the configured range
+    
+    The current port is skipped so a restart always moves to a new port,
+    unless it is the only port in the range.
+    """
+    port_min = CONFIG["port_range"]["min"]
+    port_max = CONFIG["port_range"]["max"]
+    port = random.randrange(port_min, port_max + 1)
+    if port == current_port and port_max > port_min:
+        # Draw once more from the range without the current port
+        port = random.randrange(port_min, port_max)
+        if port >= current_port:
+            port += 1
+    logger.info("Generated random port: %s", port)
     return port
 
 
-def update_docker_compose_port(new_port):
-    """Update the gerbil port in docker-compose.yml"""
+def load_yaml_file(path):
+    """Load a YAML file, reusing the cached parse while the file is unchanged"""
+    st = os.stat(path)
+    cached = _yaml_cache.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return copy.deepcopy(cached[2])
+    
+    with open(path, 'rb') as f:
+        buf = f.read()
+    data = yaml.load(buf, Loader=_Loader)
+    _yaml_cache[path] = (st.st_mtime_ns, st.st_size, data)
+    return copy.deepcopy(data)
+
+
+def dump_yaml(data):
+    """Serialize data to YAML text in the layout used for the pangolin files"""
+    return yaml.dump(data, Dumper=_Dumper, default_flow_style=False, sort_keys=False)
+
+
+def prepared_file_changed(update):
+    """Check whether a file was modified after its update was prepared"""
+    return os.stat(update[0]).st_mtime_ns != update[1]
+
+
+def find_yaml_block(text, key, pos=0, endpos=None, indent=r'[ ]*'):
+    """Find the lines nested under a "key:" line in raw YAML text
+    
+    Only keys whose indentation matches the indent pattern are considered.
+    Returns a (start, end, child_indent) tuple for the first such key with
+    a nested block, or None if there is none.
+    """
+    pattern = re.compile(
+        rf'^(?P<indent>{indent}){re.escape(key)}:[ ]*(?:#[^\r\n]*)?\r?\n'
+        r'(?P<body>(?:(?P=indent)(?:[ ]+|-(?=[ \r\n])).*(?:\n|\Z)|[ ]*\r?\n)*)',
+        re.M
+    )
+    match = pattern.search(text, pos, len(text) if endpos is None else endpos)
+    if not match:
+        return None
+    
+    start, end = match.span('body')
+    child = _CHILD_INDENT_RE.search(text, start, end)
+    if not child:
+        return None
+    return start, end, child.group(1)
+
+
+def find_gerbil_start_port(text):
+    """Find the start_port directly under the gerbil key in raw config.yml text
+    
+    Returns the regex match with "lead" and "port" groups, or None.
+    """
+    gerbil = find_yaml_block(text, 'gerbil')
+    if not gerbil:
+        return None
+    
+    start, end, child_indent = gerbil
+    pattern = re.compile(
+        rf'^(?P<lead>{re.escape(child_indent)}start_port:[ ]*)(?P<port>\d+)(?=[ \r\n]|$)',
+        re.M
+    )
+    return pattern.search(text, start, end)
+
+
+def rewrite_compose_ports(text, new_port):
+    """Rewrite the gerbil port mappings in raw docker-compose.yml text
+    
+    Only the list under gerbil's own ports key is edited. Returns the updated
+    text, or None if no UDP port mapping was found there.
+    """
+    gerbil = find_yaml_block(text, 'gerbil')
+    if not gerbil:
+        return None
+    
+    ports = find_yaml_block(text, 'ports', gerbil[0], gerbil[1], re.escape(gerbil[2]))
+    if not ports:
+        return None
+    
+    start, end, _ = ports
+    # Like the YAML fallback, every UDP and 443:443 mapping is rewritten
+    body, udp_count = _UDP_PORT_RE.subn(
+        rf'\g<lead>\g<q>{new_port}:{new_port}/udp\g<q>', text[start:end]
+    )
+    if not udp_count:
+        return None
+    logger.info("Updated UDP port mapping to: %s:%s/udp", new_port, new_port)
+    
+    body, tcp_count = _TCP_PORT_RE.subn(
+        rf'\g<lead>\g<q>{new_port}:{new_port}\g<q>', body
+    )
+    if tcp_count:
+        logger.info("Updated TCP port mapping to: %s:%s", new_port, new_port)
+    
+    return text[:start] + body + text[end:]
+
+
+def rewrite_config_port(text, new_port):
+    """Rewrite the gerbil start_port in raw config.yml text
+    
+    Returns the updated text, or None if the start_port was not found.
+    """
+    match = find_gerbil_start_port(text)
+    if not match:
+        return None
+    logger.info("Updated gerbil start_port to: %s", new_port)
+    
+    return text[:match.start('port')] + str(new_port) + text[match.end('port'):]
+
+
+def prepare_docker_compose_port(new_port):
+    """Build the docker-compose.yml contents with the gerbil port set to new_port
+    
+    Returns a (path, st_mtime_ns, text, data) update, or None on failure.
+    """
     compose_file_path = os.path.join(
         CONFIG["pangolin"]["directory"],
         CONFIG["pangolin"]["docker_compose_file"]
     )
     
     try:
-        with open(compose_file_path, 'r') as f:
-            compose_data = yaml.safe_load(f)
+        mtime_ns = os.stat(compose_file_path).st_mtime_ns
+        # newline='' keeps CRLF line endings intact through the rewrite
+        with open(compose_file_path, 'r', encoding='utf-8', newline='') as f:
+            text = f.read()
+        
+        # Edit the port mappings in place to keep comments and formatting
+        new_text = rewrite_compose_ports(text, new_port)
+        if new_text is not None:
+            return compose_file_path, mtime_ns, new_text, None
+        
+        logger.warning("gerbil UDP port mapping not found in docker-compose.yml text, rewriting via YAML")
+        compose_data = load_yaml_file(compose_file_path)
         
         # Update the ports in the gerbil service
         if 'services' in compose_data and 'gerbil' in compose_data['services']:
@@ -173,88 +411,230 @@ def update_docker_compose_port(new_port):
                     if isinstance(port_mapping, str):
                         if '/udp' in port_mapping:
                             gerbil_service['ports'][i] = f"{new_port}:{new_port}/udp"
-                            logger.info(f"Updated UDP port mapping to: {new_port}:{new_port}/udp")
+                            logger.info("Updated UDP port mapping to: %s:%s/udp", new_port, new_port)
                         elif port_mapping.startswith('443:443') and '/udp' not in port_mapping:
                             gerbil_service['ports'][i] = f"{new_port}:{new_port}"
-                            logger.info(f"Updated TCP port mapping to: {new_port}:{new_port}")
+                            logger.info("Updated TCP port mapping to: %s:%s", new_port, new_port)
         
-        # Write the updated compose file
-        with open(compose_file_path, 'w') as f:
-            yaml.dump(compose_data, f, default_flow_style=False, sort_keys=False)
-        
-        logger.info(f"Successfully updated docker-compose.yml with port {new_port}")
-        return True
+        return compose_file_path, mtime_ns, dump_yaml(compose_data), compose_data
         
     except Exception as e:
-        logger.error(f"Failed to update docker-compose.yml: {e}")
-        return False
+        logger.error("Failed to update docker-compose.yml: %s", e)
+        return None
 
 
-def update_config_port(new_port):
-    """Update the gerbil start_port in config.yml"""
+def prepare_config_port(new_port):
+    """Build the config.yml contents with the gerbil start_port set to new_port
+    
+    Returns a (path, st_mtime_ns, text, data) update, or None on failure.
+    """
     config_file_path = os.path.join(
         CONFIG["pangolin"]["directory"],
         CONFIG["pangolin"]["config_file"]
     )
     
     try:
-        with open(config_file_path, 'r') as f:
-            config_data = yaml.safe_load(f)
+        mtime_ns = os.stat(config_file_path).st_mtime_ns
+        # newline='' keeps CRLF line endings intact through the rewrite
+        with open(config_file_path, 'r', encoding='utf-8', newline='') as f:
+            text = f.read()
+        
+        # Edit the start_port in place to keep comments and formatting
+        new_text = rewrite_config_port(text, new_port)
+        if new_text is not None:
+            return config_file_path, mtime_ns, new_text, None
+        
+        logger.warning("gerbil start_port not found in config.yml text, rewriting via YAML")
+        config_data = load_yaml_file(config_file_path)
         
         # Update the gerbil start_port
         if 'gerbil' in config_data:
             config_data['gerbil']['start_port'] = new_port
-            logger.info(f"Updated gerbil start_port to: {new_port}")
+            logger.info("Updated gerbil start_port to: %s", new_port)
         else:
             logger.error("gerbil section not found in config.yml")
-            return False
+            return None
+        
+        return config_file_path, mtime_ns, dump_yaml(config_data), config_data
+        
+    except Exception as e:
+        logger.error("Failed to update config.yml: %s", e)
+        return None
+
+
+def get_current_port():
+    """Read the gerbil start_port currently set in config.yml, or None if unavailable"""
+    config_file_path = os.path.join(
+        CONFIG["pangolin"]["directory"],
+        CONFIG["pangolin"]["config_file"]
+    )
+    
+    try:
+        with open(config_file_path, 'r', encoding='utf-8', newline='') as f:
+            text = f.read()
         
-        # Write the updated config file
-        with open(config_file_path, 'w') as f:
-            yaml.dump(config_data, f, default_flow_style=False, sort_keys=False)
+        # Read the port straight from the text, the file is rewritten on every
+        # restart so a full YAML parse would never hit the cache
+        match = find_gerbil_start_port(text)
+        if match:
+            return int(match.group('port'))
         
-        logger.info(f"Successfully updated config.yml with port {new_port}")
-        return True
+        return load_yaml_file(config_file_path)['gerbil']['start_port']
+    except Exception as e:
+        logger.warning("Could not read current gerbil start_port: %s", e)
+        return None
+
+
+def prepare_port_updates(new_port):
+    """Prepare the docker-compose.yml and config.yml updates for new_port
+    
+    Returns an (updates, error) tuple where error is None on success.
+    """
+    compose_update = prepare_docker_compose_port(new_port)
+    if compose_update is None:
+        return None, "Failed to update docker-compose.yml"
+    
+    config_update = prepare_config_port(new_port)
+    if config_update is None:
+        return None, "Failed to update config.yml"
+    
+    return [compose_update, config_update], None
+
+
+def write_temp_file(path, text):
+    """Write text to path + ".tmp" with the mode and owner of path
+    
+    config.yml holds secrets, so the temp file gets the original mode before
+    any data is written to it.
+    """
+    st = os.stat(path)
+    # O_BINARY keeps Windows from translating line endings on a low-level fd
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fd = os.open(path + ".tmp", flags, st.st_mode & 0o777)
+    with open(fd, 'wb') as f:
+        # Apply the mode explicitly, the umask or a leftover temp file may differ.
+        # fchmod and fchown are POSIX-only (fchmod until Python 3.13)
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fd, st.st_mode & 0o777)
+        if hasattr(os, 'fchown'):
+            try:
+                os.fchown(fd, st.st_uid, st.st_gid)
+            except OSError as e:
+                logger.warning("Could not keep the owner of %s: %s", path, e)
+        f.write(text.encode('utf-8'))
+
+
+def apply_port(new_port, updates):
+    """Write the prepared docker-compose.yml and config.yml updates for new_port
+    
+    Both files are staged as temporary files next to their targets and then
+    moved into place with os.replace back to back. If staging fails, neither
+    file is touched. If a later os.replace fails, the files replaced before
+    it already hold the new port while the rest keep the old one.
+    Returns a (success, error) tuple.
+    """
+    file_name = None
+    try:
+        for path, _, text, _ in updates:
+            file_name = os.path.basename(path)
+            write_temp_file(path, text)
         
+        for path, _, _, _ in updates:
+            file_name = os.path.basename(path)
+            os.replace(path + ".tmp", path)
+            logger.info("Successfully updated %s with port %s", file_name, new_port)
     except Exception as e:
-        logger.error(f"Failed to update config.yml: {e}")
-        return False
+        for path, _, _, _ in updates:
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+        logger.error("Failed to update %s: %s", file_name, e)
+        return False, f"Failed to update {file_name}"
+    
+    # Refresh the YAML cache for files that were rewritten from parsed data
+    for path, _, _, data in updates:
+        if data is not None:
+            st = os.stat(path)
+            _yaml_cache[path] = (st.st_mtime_ns, st.st_size, data)
+    
+    return True, None
 
 
 def restart_pangolin():
-    """Complete restart process with port randomization"""
+    """Complete restart process with port randomization
+    
+    The file updates are prepared before taking restart_lock, so the lock is
+    only held while the containers are stopped, the files are written and
+    the containers are started again. Raises RestartInProgress if another
+    restart holds the lock.
+    """
     try:
-        # Generate new random port
-        new_port = generate_random_port()
+        # Generate new random port, different from the current one
+        new_port = generate_random_port(get_current_port())
+        
+        # Build the updated docker-compose.yml and config.yml
+        updates, error = prepare_port_updates(new_port)
+        if error:
+            return False, error
+        
+    except Exception as e:
+        logger.error("Restart process failed: %s", e)
+        return False, f"Restart failed: {str(e)}"
+    
+    if not restart_lock.acquire(blocking=False):
+        raise RestartInProgress()
+    
+    try:
+        # Another restart may have rewritten the files since they were prepared
+        if any(prepared_file_changed(update) for update in updates):
+            updates, error = prepare_port_updates(new_port)
+            if error:
+                return False, error
         
         # Stop containers
         if not stop_containers():
             return False, "Failed to stop containers"
         
-        # Update docker-compose.yml
-        if not update_docker_compose_port(new_port):
-            return False, "Failed to update docker-compose.yml"
-        
-        # Update config.yml
-        if not update_config_port(new_port):
-            return False, "Failed to update config.yml"
+        # Write docker-compose.yml and config.yml
+        success, error = apply_port(new_port, updates)
+        if not success:
+            return False, error
         
         # Start containers
         if not start_containers():
             return False, "Failed to start containers"
         
-        logger.info(f"Successfully restarted Pangolin with new port: {new_port}")
+        logger.info("Successfully restarted Pangolin with new port: %s", new_port)
         return True, f"Pangolin restarted successfully with port {new_port}"
         
     except Exception as e:
-        logger.error(f"Restart process failed: {e}")
+        logger.error("Restart process failed: %s", e)
         return False, f"Restart failed: {str(e)}"
+    finally:
+        restart_lock.release()
+        # Restarts are rare, don't leave their log records sitting in the buffer
+        flush_log_buffer()
 
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Health check endpoint"""
-    return jsonify({
+def cached_json_body(key, build):
+    """Return a JSON body that is serialized once per configuration"""
+    body = _response_cache.get(key)
+    if body is None:
+        with _response_cache_lock:
+            body = _response_cache.get(key)
+            if body is None:
+                body = _json_dumps(build())
+                _response_cache[key] = body
+    return body
+
+
+def cached_json_response(key, build):
+    """Return a JSON response built from a cached body"""
+    return Response(cached_json_body(key, build), mimetype='application/json')
+
+
+def build_health_status():
+    """Build the health check payload from the current configuration"""
+    return {
         "status": "healthy",
         "service": "pangolin-restart-service",
         "config": {
@@ -262,81 +642,126 @@ def health_check():
             "pangolin_directory": CONFIG["pangolin"]["directory"],
             "listen_port": CONFIG["service"]["listen_port"]
         }
-    })
+    }
+
+
+def health_fast_path(wsgi_app):
+    """Wrap a WSGI app so GET /health is answered before Flask routing runs"""
+    def middleware(environ, start_response):
+        if environ.get('PATH_INFO') == '/health' and environ.get('REQUEST_METHOD') == 'GET':
+            body = cached_json_body('health', build_health_status)
+            start_response('200 OK', [
+                ('Content-Type', 'application/json'),
+                ('Content-Length', str(len(body)))
+            ])
+            return [body]
+        return wsgi_app(environ, start_response)
+    return middleware
+
+
+app.wsgi_app = health_fast_path(app.wsgi_app)
+
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Health check endpoint"""
+    return cached_json_response('health', build_health_status)
 
 
 @app.route('/restart', methods=['POST'])
 def handle_restart():
     """Handle restart command"""
-    with restart_lock:
-        try:
-            # Check if request contains the restart command
-            data = request.get_json() if request.is_json else {}
-            command = data.get('command', '') if data else request.form.get('command', '')
-            
-            if command != 'restart_pangolin':
-                return jsonify({
-                    "error": "Invalid command. Expected 'restart_pangolin'"
-                }), 400
-            
-            logger.info("Received restart_pangolin command")
-            
-            # Execute restart process
-            success, message = restart_pangolin()
-            
-            if success:
-                return jsonify({
-                    "status": "success",
-                    "message": message
-                })
-            else:
-                return jsonify({
-                    "status": "error",
-                    "message": message
-                }), 500
-                
-        except Exception as e:
-            logger.error(f"Error handling restart request: {e}")
+    try:
+        # Check if request contains the restart command
+        data = request.get_json() if request.is_json else {}
+        command = data.get('command', '') if data else request.form.get('command', '')
+        
+        if command != 'restart_pangolin':
+            return jsonify({
+                "error": "Invalid command. Expected 'restart_pangolin'"
+            }), 400
+        
+        logger.info("Received restart_pangolin command")
+        
+        # Execute restart process
+        success, message = restart_pangolin()
+        
+        if success:
+            return jsonify({
+                "status": "success",
+                "message": message
+            })
+        else:
             return jsonify({
                 "status": "error",
-                "message": f"Internal server error: {str(e)}"
+                "message": message
             }), 500
+    
+    except RestartInProgress:
+        # Reject concurrent restarts instead of queueing them behind the lock
+        logger.warning("Restart already in progress, rejecting request")
+        flush_log_buffer()
+        return jsonify({
+            "status": "busy",
+            "message": "A restart is already in progress"
+        }), 429
+    except Exception as e:
+        logger.error("Error handling restart request: %s", e)
+        return jsonify({
+            "status": "error",
+            "message": f"Internal server error: {str(e)}"
+        }), 500
 
 
 @app.route('/config', methods=['GET'])
 def get_config():
     """Get current service configuration"""
-    return jsonify(CONFIG)
+    return cached_json_response('config', lambda: CONFIG)
 
 
 @app.route('/config', methods=['POST'])
 def update_config():
     """Update service configuration"""
+    global CONFIG
+    
     try:
         data = request.get_json()
         if not data:
             return jsonify({"error": "No JSON data provided"}), 400
         
-        # Deep merge the configuration
+        # Deep merge the configuration, walking nested sections with a stack
         def deep_merge(target, source):
-            for key, value in source.items():
-                if key in target and isinstance(target[key], dict) and isinstance(value, dict):
-                    deep_merge(target[key], value)
-                else:
-                    target[key] = value
+            stack = [(target, source)]
+            while stack:
+                target, source = stack.pop()
+                for key, value in source.items():
+                    target_value = target.get(key)
+                    if isinstance(target_value, dict) and isinstance(value, dict):
+                        stack.append((target_value, value))
+                    else:
+                        target[key] = value
         
-        # Update configuration
-        deep_merge(CONFIG, data)
+        # Merge into a copy and serialize it before touching the file, so a
+        # failure leaves both CONFIG and service_config.json unchanged
+        new_config = copy.deepcopy(CONFIG)
+        deep_merge(new_config, data)
+        body = _json_dumps(new_config, indent=2)
         
         # Save to file
-        with open("service_config.json", 'w') as f:
-            json.dump(CONFIG, f, indent=2)
+        with open("service_config.json", 'wb') as f:
+            f.write(body)
+        
+        # Update configuration
+        with _response_cache_lock:
+            CONFIG = new_config
+            _response_cache.clear()
         
         # Re-setup logging if service config changed
         if 'service' in data:
             setup_logging()
         
         logger.info("Configuration updated")
+        flush_log_buffer()
         return jsonify({
             "status": "success",
             "message": "Configuration updated",
@@ -344,7 +769,7 @@ def update_config():
         })
         
     except Exception as e:
-        logger.error(f"Error updating configuration: {e}")
+        logger.error("Error updating configuration: %s", e)
         return jsonify({
             "status": "error",
             "message": f"Failed to update configuration: {str(e)}"
@@ -355,20 +780,33 @@ if __name__ == '__main__':
     # Load configuration
     config_file = sys.argv[1] if len(sys.argv) > 1 else "service_config.json"
     load_config(config_file)
+    signal.signal(signal.SIGTERM, handle_sigterm)
     
     # Validate pangolin directory exists
     if not os.path.exists(CONFIG["pangolin"]["directory"]):
-        logger.error(f"Pangolin directory not found: {CONFIG['pangolin']['directory']}")
+        logger.error("Pangolin directory not found: %s", CONFIG['pangolin']['directory'])
         sys.exit(1)
     
-    logger.info(f"Starting Pangolin Restart Service...")
-    logger.info(f"Listening on {CONFIG['service']['listen_host']}:{CONFIG['service']['listen_port']}")
-    logger.info(f"Port range: {CONFIG['port_range']['min']}-{CONFIG['port_range']['max']}")
-    logger.info(f"Pangolin directory: {CONFIG['pangolin']['directory']}")
-    logger.info(f"Docker sudo: {CONFIG['docker']['use_sudo']}")
+    logger.info("Starting Pangolin Restart Service...")
+    logger.info("Listening on %s:%s", CONFIG['service']['listen_host'], CONFIG['service']['listen_port'])
+    logger.info("Port range: %s-%s", CONFIG['port_range']['min'], CONFIG['port_range']['max'])
+    logger.info("Pangolin directory: %s", CONFIG['pangolin']['directory'])
+    logger.info("Docker sudo: %s", CONFIG['docker']['use_sudo'])
+    flush_log_buffer()
     
-    app.run(
-        host=CONFIG["service"]["listen_host"],
-        port=CONFIG["service"]["listen_port"],
-        debug=False
-    )
+    try:
+        from waitress import serve
+    except ImportError:
+        logger.warning("waitress is not installed, falling back to the Flask development server")
+        app.run(
+            host=CONFIG["service"]["listen_host"],
+            port=CONFIG["service"]["listen_port"],
+            debug=False
+        )
+    else:
+        serve(
+            app,
+            host=CONFIG["service"]["listen_host"],
+            port=CONFIG["service"]["listen_port"],
+            threads=8
+        )
@@ -3,13 +3,23 @@
 Configuration validation script for Pangolin Restart Service
 """
 
+import functools
 import json
 import sys
 import os
 
+@functools.lru_cache(maxsize=None)
+def _exists(path):
+    """Check whether a path exists, stat-ing each unique path only once"""
+    try:
+        os.stat(path)
+        return True
+    except (OSError, ValueError):
+        return False
+
 def validate_config(config_file):
     """Validate the configuration file"""
-    if not os.path.exists(config_file):
+    if not _exists(config_file):
         print(f"❌ Configuration file not found: {config_file}")
         return False
     
@@ -49,16 +59,17 @@ def validate_config(config_file):
     if 'pangolin' in config:
         pangolin = config['pangolin']
         if 'directory' in pangolin:
-            if not os.path.exists(pangolin['directory']):
+            if not _exists(pangolin['directory']):
                 warnings.append(f"Pangolin directory does not exist: {pangolin['directory']}")
-            elif 'docker_compose_file' in pangolin:
-                compose_path = os.path.join(pangolin['directory'], pangolin['docker_compose_file'])
-                if not os.path.exists(compose_path):
-                    warnings.append(f"Docker compose file not found: {compose_path}")
-            elif 'config_file' in pangolin:
-                config_path = os.path.join(pangolin['directory'], pangolin['config_file'])
-                if not os.path.exists(config_path):
-                    warnings.append(f"Pangolin config file not found: {config_path}")
+            else:
+                if 'docker_compose_file' in pangolin:
+                    compose_path = os.path.join(pangolin['directory'], pangolin['docker_compose_file'])
+                    if not _exists(compose_path):
+                        warnings.append(f"Docker compose file not found: {compose_path}")
+                if 'config_file' in pangolin:
+                    config_path = os.path.join(pangolin['directory'], pangolin['config_file'])
+                    if not _exists(config_path):
+                        warnings.append(f"Pangolin config file not found: {config_path}")
     
     # Validate port range
     if 'port_range' in config: